@@ -1,8 +1,16 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
-from bs4 import BeautifulSoup
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+import functools
+import io
+import json
+import orjson
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+from lxml import etree
 
 # ===================== 頁面設定 =====================
 st.set_page_config(
@@ -11,24 +19,68 @@ st.set_page_config(
     layout="centered"
 )
 
+# ===================== 共用資源 =====================
+# 所有匯率請求共用連線（HTTP keep-alive）
+# 主程式每次 rerun 都會重新執行，需以 cache_resource 保留跨 rerun 的同一物件
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    return session
+
+SESSION = get_http_session()
+
+# 匯率抓取共用的執行緒池，避免每次首次載入重新建立執行緒
+@st.cache_resource(show_spinner=False)
+def get_fetch_pool():
+    return ThreadPoolExecutor(max_workers=3)
+
+_FETCH_POOL = get_fetch_pool()
+
 # ===================== CSS =====================
-st.markdown(
-    """
-    <style>
-    .block-container {
-        max-width: 550px;
-        padding-top: 1rem;
-        padding-bottom: 1rem;
-        padding-left: 0.1rem;
-        padding-right: 0.1rem;
-    }
-    .stButton>button {
-        font-weight: bold;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+# 每次 rerun 都必須重新送出（未輸出的元素會被移除），改用 st.html 跳過 Markdown 解析
+# 僅含 <style> 的 st.html 不佔版面需 Streamlit 1.45 以上（見 requirements.txt）
+STYLE_CSS = """
+<style>
+.block-container {
+    max-width: 550px;
+    padding-top: 1rem;
+    padding-bottom: 1rem;
+    padding-left: 0.1rem;
+    padding-right: 0.1rem;
+}
+.stButton>button {
+    font-weight: bold;
+}
+</style>
+"""
+st.html(STYLE_CSS)
+
+# ===================== 台銀美元欄位 =====================
+def _find_bot_usd_cell(content):
+    # 只在快取未命中時執行，XPath 於此編譯，避免每次 rerun 重新編譯
+    is_usd_row = etree.XPath(
+        "boolean(self::tr[contains(., '美元')]/ancestor::tbody"
+        "/ancestor::table[contains(concat(' ', normalize-space(@class), ' '), ' table ')])"
+    )
+
+    # 邊解析邊比對 <tr>，找到美元列即停止，不必建出整頁的樹
+    rows = etree.iterparse(
+        io.BytesIO(content), events=("end",), tag="tr", html=True, encoding="utf-8"
+    )
+    for _, row in rows:
+        if is_usd_row(row):
+            cells = row.findall("td")
+            return cells[4] if len(cells) > 4 else None
+    return None
+
+# 上次成功抓取的匯率與驗證標頭；快取過期時以條件式 GET 詢問，304 即沿用
+@st.cache_resource(show_spinner=False)
+def get_bot_validators():
+    return {"rate": None, "etag": None, "last_modified": None}
+
+_BOT_LAST = get_bot_validators()
 
 # ===================== 輔助函數 =====================
 def format_large_number(num):
@@ -39,46 +91,118 @@ def format_large_number(num):
     else:
         return f"{num:,.3f}"
 
+def format_series(arr):
+    # format_large_number 的向量版，供日後整欄轉成文字時使用；
+    # 純量輸入會回傳長度 1 的陣列而非 str，不能直接取代 format_large_number
+    arr = np.atleast_1d(np.asarray(arr, dtype=np.float64))
+    a = np.abs(arr)
+    conds = [a >= 1_000_000, a >= 1_000]
+    scale = np.select(conds, [1_000_000, 1_000], 1.0)
+    suffix = np.select(conds, [" M", " K"], "")
+    return np.array([f"{v:,.3f}{u}" for v, u in zip((arr / scale).tolist(), suffix.tolist())])
+
+# ===================== 匯率快取 =====================
+# 記憶體（st.cache_data）＋磁碟（JSON 檔）兩層，讓程序重啟後仍可沿用匯率。
+# st.cache_data 的 persist="disk" 會忽略 ttl，因此自行保存抓取時間；
+# 兩層都以同一個抓取時間判斷過期，不會疊加成兩倍 TTL。
+_DISK_CACHE_DIR = Path.home() / ".streamlit" / "cache"
+
+def rate_cache(ttl):
+    def decorator(func):
+        path = _DISK_CACHE_DIR / f"{func.__name__}.json"
+
+        @functools.wraps(func)
+        def load():
+            try:
+                saved = json.loads(path.read_text())
+                if time.time() - saved["fetched_at"] < ttl:
+                    return saved
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+            saved = {"fetched_at": time.time(), "value": func()}
+            if saved["value"] is not None:
+                try:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.write_text(json.dumps(saved))
+                except OSError:
+                    pass
+            return saved
+
+        cached = st.cache_data(ttl=ttl, show_spinner=False)(load)
+
+        @functools.wraps(func)
+        def wrapper():
+            saved = cached()
+            if time.time() - saved["fetched_at"] >= ttl:
+                cached.clear()
+                saved = cached()
+            return saved["value"]
+
+        def clear():
+            cached.clear()
+            path.unlink(missing_ok=True)
+
+        wrapper.clear = clear
+        return wrapper
+    return decorator
+
 # ===================== 台銀 USD 匯率 =====================
-@st.cache_data(ttl=3600)
+@rate_cache(ttl=3600)
 def get_tw_bank_usd_rate():
     try:
         url = "https://rate.bot.com.tw/xrt?Lang=zh-TW"
-        res = requests.get(url, timeout=10)
+        headers = {}
+        if _BOT_LAST["rate"] is not None:
+            if _BOT_LAST["etag"]:
+                headers["If-None-Match"] = _BOT_LAST["etag"]
+            if _BOT_LAST["last_modified"]:
+                headers["If-Modified-Since"] = _BOT_LAST["last_modified"]
+
+        res = SESSION.get(url, headers=headers, timeout=10)
+        if res.status_code == 304:
+            return _BOT_LAST["rate"]
         res.raise_for_status()
-        soup = BeautifulSoup(res.text, "html.parser")
-        for row in soup.select("table.table tbody tr"):
-            if "美元" in row.text:
-                return float(row.select("td")[4].text.strip())
+
+        cell = _find_bot_usd_cell(res.content)
+        if cell is not None:
+            rate = float(cell.xpath("string()").strip())
+            _BOT_LAST.update(
+                rate=rate,
+                etag=res.headers.get("ETag"),
+                last_modified=res.headers.get("Last-Modified")
+            )
+            return rate
     except Exception:
         pass
     return None
 # ===================== 人民幣匯率（Yahoo） =====================
-@st.cache_data(ttl=3600)
+@rate_cache(ttl=3600)
 def get_cny_twd_rate():
     try:
         url = "https://query1.finance.yahoo.com/v8/finance/chart/CNYTWD=X"
-        res = requests.get(url, timeout=10)
+        res = SESSION.get(url, timeout=10)
         res.raise_for_status()
-        data = res.json()
+        data = orjson.loads(res.content)
         return data["chart"]["result"][0]["meta"]["regularMarketPrice"]
     except Exception:
         return None
 # ===================== ECB 匯率 =====================
-@st.cache_data(ttl=3600)
+@rate_cache(ttl=3600)
 def get_ecb_rates():
     url = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml"
-    res = requests.get(url, timeout=10)
+    res = SESSION.get(url, timeout=10)
     res.raise_for_status()
 
-    tree = ET.fromstring(res.content)
-    rates = {}
-    for cube in tree.findall(".//{*}Cube[@currency]"):
-        rates[cube.attrib["currency"]] = float(cube.attrib["rate"])
+    tree = etree.fromstring(res.content)
+    cubes = tree.xpath(
+        "//ns:Cube[@currency]",
+        namespaces={"ns": "http://www.ecb.int/vocabulary/2002-08-01/eurofxref"}
+    )
+    rates = {c.get("currency"): float(c.get("rate")) for c in cubes}
     return rates  # EUR base
 
 # ===================== 顯示用匯率（TWD base） =====================
-@st.cache_data(ttl=3600)
 def get_display_currency_rates(usd_twd_rate):
     rates = {"TWD": 1.0}
 
@@ -100,8 +224,10 @@ def get_display_currency_rates(usd_twd_rate):
     return rates
 
 # ===================== 計算表 =====================
-def calculate_price_table(cost, currency, usd_rate, quantity):
+@st.cache_data(max_entries=128)
+def calculate_price_table(cost, currency, usd_rate, cny_rate, quantity):
     # --- 成本轉 TWD ---
+    # 匯率皆由參數傳入，讓快取鍵涵蓋所有輸入
     if currency == "TWD":
         cost_twd = cost
 
@@ -109,30 +235,30 @@ def calculate_price_table(cost, currency, usd_rate, quantity):
         cost_twd = cost * usd_rate
 
     elif currency == "CNY":
-        cny_rate = get_cny_twd_rate()
-        if cny_rate:
-            cost_twd = cost * cny_rate
-        else:
-            st.warning("⚠️ 無法取得人民幣匯率，暫以 4.3 計算")
-            cost_twd = cost * 4.3  # fallback
+        cost_twd = cost * cny_rate
 
     else:
         cost_twd = cost
 
     # --- 利潤計算 ---
-    profit_rates = [0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.5]
-    rows = []
+    # 級距與標籤只在快取未命中時建立，快取命中的 rerun 不需付出成本
+    profit_rates = np.array([0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.5])
+    labels = pd.CategoricalDtype(
+        [f"{int(r * 100)}%" for r in profit_rates.tolist()], ordered=True
+    )
+
+    selling = cost_twd / (1.0 - profit_rates)
+    unit = selling - cost_twd
 
-    for r in profit_rates:
-        selling_price = cost_twd / (1 - r)
-        rows.append({
-            "利潤比例": f"{int(r * 100)}%",
-            "利潤率售價 (TWD)": round(selling_price, 3),
-            "單個利潤 (TWD)": round(selling_price - cost_twd, 3),
-            "總利潤 (TWD)": round((selling_price - cost_twd) * quantity, 3)
-        })
+    df = pd.DataFrame({
+        "利潤比例_float": profit_rates,
+        "利潤比例": pd.Categorical.from_codes(np.arange(len(profit_rates)), dtype=labels),
+        "利潤率售價 (TWD)": selling.round(3),
+        "單個利潤 (TWD)": unit.round(3),
+        "總利潤 (TWD)": (unit * quantity).round(3)
+    }, copy=False)
 
-    return pd.DataFrame(rows), cost_twd
+    return df, cost_twd
 
 # ===================== UI =====================
 st.title("🛒 採購決策與定價評估")
@@ -148,7 +274,11 @@ with col2:
 
 with col3:
     if "usd_rate" not in st.session_state:
-        st.session_state.usd_rate = get_tw_bank_usd_rate() or 32.0
+        # 首次載入：台銀與 ECB 同時抓取，ECB 結果先進快取供下方比較表使用
+        f_usd = _FETCH_POOL.submit(get_tw_bank_usd_rate)
+        f_ecb = _FETCH_POOL.submit(get_ecb_rates)
+        wait([f_usd, f_ecb])
+        st.session_state.usd_rate = f_usd.result() or 32.0
 
     usd_rate = st.number_input(
         "USD → TWD",
@@ -163,16 +293,23 @@ with col4:
 
 st.markdown("---")
 
-if st.button("更新台銀匯率", use_container_width=True):
-    st.cache_data.clear()
-    new_rate = get_tw_bank_usd_rate()
-    if new_rate:
-        st.session_state.usd_rate = new_rate
-        st.rerun()
+def _on_refresh():
+    # 在 callback 中更新，按鈕觸發的那一次 rerun 即會帶入新匯率
+    get_tw_bank_usd_rate.clear()
+    st.session_state.usd_rate = get_tw_bank_usd_rate() or st.session_state.usd_rate
+
+st.button("更新台銀匯率", on_click=_on_refresh, use_container_width=True)
 
 # ===================== 計算 =====================
 if cost > 0:
-    df_result, cost_twd = calculate_price_table(cost, currency, usd_rate, quantity)
+    cny_rate = None
+    if currency == "CNY":
+        cny_rate = get_cny_twd_rate()
+        if not cny_rate:
+            st.warning("⚠️ 無法取得人民幣匯率，暫以 4.3 計算")
+            cny_rate = 4.3  # fallback
+
+    df_result, cost_twd = calculate_price_table(cost, currency, usd_rate, cny_rate, quantity)
 
     st.subheader("🎯 定價決策")
     profit_ratio = st.slider("目標利潤率 (%)", 0.0, 50.0, 20.0, 0.1)
@@ -199,14 +336,12 @@ if cost > 0:
     display_rate = rates[display_currency]
     st.caption(f"📌 匯率：1 {display_currency} = {display_rate:.4f} TWD")
 
-    df_display = df_result.copy()
-    df_display[f"利潤率售價 ({display_currency})"] = (
-        df_display["利潤率售價 (TWD)"] / display_rate
-    ).round(3)
-
-    df_display = df_display[
-        ["利潤比例", f"利潤率售價 ({display_currency})", "單個利潤 (TWD)", "總利潤 (TWD)"]
-    ]
+    df_display = pd.DataFrame({
+        "利潤比例": df_result["利潤比例"].values,
+        f"利潤率售價 ({display_currency})": (df_result["利潤率售價 (TWD)"].values / display_rate).round(3),
+        "單個利潤 (TWD)": df_result["單個利潤 (TWD)"].values,
+        "總利潤 (TWD)": df_result["總利潤 (TWD)"].values
+    })
 
     st.dataframe(df_display, use_container_width=True)
 